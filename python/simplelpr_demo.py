@@ -1,18 +1,144 @@
-import sys, os, argparse
+import sys, os, argparse, glob, json, mmap, queue, secrets, struct, threading
+import concurrent.futures
+import multiprocessing.connection
+
+# File extensions of the images picked up when a directory is supplied.
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+# Python versions the simplelpr extension is available for, and the message shown on any other version.
+
+SUPPORTED_PYTHON_VERSIONS = {(3, 8), (3, 9)}
+UNSUPPORTED_PYTHON_MESSAGE = 'This demo requires either Python 3.8 or 3.9'
+
+# Default address of the analysis server, and environment variable the authentication key can be supplied through.
+# There is no default key: requests are unpickled by the server, so the key must be known to trusted clients only.
+
+DEFAULT_SERVER_ADDRESS = 'localhost:6000'
+AUTHKEY_ENV_VAR = 'SIMPLELPR_AUTHKEY'
+
+
+# Creates a SimpleLPR engine. The extension is imported here, so that commands that don't need an engine
+# (like '--help' or 'submit') don't pay the cost of loading it.
+
+def create_engine(show_version):
+    # The simplelpr extension requires 64-bit Python 3.8 or 3.9
+
+    if sys.version_info[:2] not in SUPPORTED_PYTHON_VERSIONS:
+        raise RuntimeError(UNSUPPORTED_PYTHON_MESSAGE)
+
+    # Import the SimpleLPR extension.
+    import simplelpr
+
+    setupP = simplelpr.EngineSetupParms()
+    eng = simplelpr.SimpleLPR(setupP)
+
+    if show_version:
+        v = eng.versionNumber
+        print(f'SimpleLPR version: {v.A}.{v.B}.{v.C}.{v.D}')
+
+    return eng
 
-# Import the SimpleLPR extension.
-import simplelpr
 
 # Lists all available countries.
 
 def list_countries(eng):
-    print('List of available countries:')
+    codes = [eng.get_countryCode(i) for i in range(eng.numSupportedCountries)]
+
+    sys.stdout.write('List of available countries:\n' + '\n'.join(codes) + '\n')
+
+
+# Expands the image path argument, which can be either a file, a directory or a glob pattern, into a list of files.
+
+def list_image_files(img_path):
+    if os.path.isfile(img_path):
+        return [img_path]
+
+    if os.path.isdir(img_path):
+        # Directory entries carry their file type, so no additional stat calls are needed.
+        with os.scandir(img_path) as it:
+            return sorted(e.path for e in it if e.is_file() and e.name.lower().endswith(IMAGE_EXTENSIONS))
+
+    return [p for p in sorted(glob.glob(img_path)) if os.path.isfile(p) and p.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+# Text report templates. They are defined once here rather than rebuilt for every candidate, match and glyph.
+
+IMAGE_FORMAT = ('=============================\n'
+                'Image: {path}\n'
+                'Number of detected candidates: {count}')
+
+CANDIDATE_FORMAT = ('-----------------------------\n'
+                    'darkOnLight: {c.darkOnLight} , plateDetectionConfidence: {c.plateDetectionConfidence}\n'
+                    'boundingBox: {c.boundingBox}\n'
+                    'plateRegionVertices: {c.plateRegionVertices}')
+
+MATCH_FORMAT = ("\tcountry: '{m.country}' , countryISO: '{m.countryISO}' , text: '{m.text}' , "
+                "confidence: {m.confidence:.3f}")
+
+GLYPH_FORMAT = "\t\tglyph: '{e.glyph}' , confidence: {e.confidence:.3f} , boundingBox: {e.boundingBox}"
+
+IMAGE_ERROR_FORMAT = ('=============================\n'
+                      'Image: {path}\n'
+                      'Error: {error}')
+
 
-    for i in range(0, eng.numSupportedCountries):
-        print(eng.get_countryCode(i))
+# Formats the license plate candidates found in an image as a list of text blocks.
 
+def format_candidates(img_path, cds):
+    parts = [IMAGE_FORMAT.format(path=img_path, count=len(cds))]
 
-def analyze_file(eng, country_id, img_path, key_path):
+    for cand in cds:
+        parts.append(CANDIDATE_FORMAT.format(c=cand))
+
+        for cm in cand.matches:
+            parts.append(MATCH_FORMAT.format(m=cm))
+            parts.extend(GLYPH_FORMAT.format(e=e) for e in cm.elements)
+
+    return parts
+
+
+# Converts the license plate candidates found in an image into plain Python objects, suitable for JSON serialization.
+
+def rect_to_dict(r):
+    return {'left': r.left, 'top': r.top, 'width': r.width, 'height': r.height}
+
+
+def candidates_to_dict(img_path, cds):
+    return {
+        'image': img_path,
+        'candidates': [
+            {
+                'darkOnLight': cand.darkOnLight,
+                'plateDetectionConfidence': cand.plateDetectionConfidence,
+                'boundingBox': rect_to_dict(cand.boundingBox),
+                'plateRegionVertices': [{'x': v.x, 'y': v.y} for v in cand.plateRegionVertices],
+                'matches': [
+                    {
+                        'country': cm.country,
+                        'countryISO': cm.countryISO,
+                        'text': cm.text,
+                        'confidence': cm.confidence,
+                        'elements': [
+                            {
+                                'glyph': e.glyph,
+                                'confidence': e.confidence,
+                                'boundingBox': rect_to_dict(e.boundingBox)
+                            }
+                            for e in cm.elements
+                        ]
+                    }
+                    for cm in cand.matches
+                ]
+            }
+            for cand in cds
+        ]
+    }
+
+
+# Sets up the engine for the analysis of images of the selected country.
+
+def setup_engine(eng, country_id, key_path):
     # Enables syntax verification with the selected country.
     eng.set_countryWeight(country_id, 1)
     eng.realizeCountryWeights()
@@ -27,79 +153,282 @@ def analyze_file(eng, country_id, img_path, key_path):
     #     key_content = file.read()
     # eng.set_productKey( key_content )
 
-    # Create a Processor object. Every working thread should use its own processor.
-    proc = eng.createProcessor()
 
-    # Enable the plate region detection and crop to plate region features.
-    proc.plateRegionDetectionEnabled = True
-    proc.cropToPlateRegionEnabled = True
+# Creates one Processor object per working thread. Every working thread should use its own processor, which is
+# reused for all the images analyzed by that thread.
+
+def create_processors(eng, num_threads):
+    procs = []
 
-    # Looks for license plate candidates in an image in the file system.
-    cds = proc.analyze(img_path)
+    for _ in range(num_threads):
+        proc = eng.createProcessor()
 
-    # Alternatively, the input image can be supplied through an object supporting the buffer protocol:
-    #
-    # fh = open(img_path, 'rb')
-    # try:
-    #     ba = bytearray(fh.read())
-    # finally:
-    #     fh.close()
-    # cds = proc.analyze(ba)
-    #
-    # or	
-    #
-    # import numpy as np
-    # from PIL import Image
-    #
-    # im = Image.open(img_path)
-    # npi = np.asarray(im)
-    # cds = proc.analyze(npi)
-    #
-    # or
-    #
-    # import cv2
-    #
-    # im = cv2.imread(img_path)
-    # cds = proc.analyze(im)
+        # Enable the plate region detection and crop to plate region features.
+        proc.plateRegionDetectionEnabled = True
+        proc.cropToPlateRegionEnabled = True
 
-    # Show the detection results.
-    print('Number of detected candidates:', len(cds))
+        procs.append(proc)
 
-    for cand in cds:
-        print('-----------------------------')
-        print('darkOnLight:', cand.darkOnLight, ', plateDetectionConfidence:', cand.plateDetectionConfidence)
-        print('boundingBox:', cand.boundingBox)
-        print('plateRegionVertices:', cand.plateRegionVertices)
+    return procs
 
-        for cm in cand.matches:
-            print('\tcountry:', "'{:}'".format(cm.country), ', countryISO:', "'{:}'".format(cm.countryISO),
-                  ', text:', "'{:}'".format(cm.text), ', confidence:', '{:.3f}'.format(cm.confidence))
 
-            for e in cm.elements:
-                print('\t\tglyph:', "'{:}'".format(e.glyph), ', confidence:', '{:.3f}'.format(e.confidence),
-                      ', boundingBox:', e.boundingBox)
+# Looks for license plate candidates in a list of images, analyzing them in parallel with the supplied processors.
+# Returns a list of (image path, candidates) pairs. Images that could not be read or analyzed are paired with the
+# exception raised instead, so that one bad image doesn't discard the results of the others.
 
+def analyze_images(procs, img_paths):
+    # There is no point in having more threads than images.
+    num_threads = min(len(procs), len(img_paths))
+
+    # The image files are mapped in memory ahead of time by a reader thread and handed to the workers through a
+    # bounded queue, so that disk I/O overlaps with the analysis without loading all the images in memory at once.
+    # Mapping the files rather than reading them avoids copying their contents into the Python heap.
+    buffers = queue.Queue(maxsize=2 * num_threads)
+    results = [None] * len(img_paths)
+
+    # Set when the analysis is interrupted, to make the reader and the workers stop early.
+    stop = threading.Event()
+
+    def read_files():
+        try:
+            for i, p in enumerate(img_paths):
+                if stop.is_set():
+                    break
+
+                try:
+                    with open(p, 'rb') as fh:
+                        # Empty files cannot be mapped. They are reported as a failed image, like any other.
+                        if os.fstat(fh.fileno()).st_size == 0:
+                            results[i] = RuntimeError('Empty image file')
+                            continue
+
+                        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                except OSError as e:
+                    results[i] = e
+                    continue
+
+                # Ask the OS to start reading the file in the background, where supported. This is only a hint, so
+                # failing to give it doesn't prevent the image from being analyzed.
+                try:
+                    if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+                        mm.madvise(mmap.MADV_WILLNEED)
+                except OSError:
+                    pass
+
+                buffers.put((i, mm))
+        finally:
+            # Tell every worker there are no more images.
+            for _ in range(num_threads):
+                buffers.put(None)
+
+    def analyze_files(proc):
+        while True:
+            item = buffers.get()
+
+            if item is None:
+                break
+
+            i, mm = item
+
+            # Once interrupted, keep consuming the queue without analyzing, so that the reader thread does not block
+            # and the pending mappings are closed.
+            if stop.is_set():
+                mm.close()
+                continue
+
+            try:
+                # Looks for license plate candidates in an image supplied through an object supporting the buffer
+                # protocol. Passing the encoded file contents lets the native decoder do the work, and avoids
+                # decoding the image in Python (e.g. with PIL or OpenCV) only to copy the uncompressed pixels again.
+                results[i] = proc.analyze(mm)
+
+                # Alternatively, the file contents can be supplied in a bytearray:
+                #
+                # with open(img_paths[i], 'rb') as fh:
+                #     cds = proc.analyze(bytearray(fh.read()))
+                #
+                # or the path to the image in the file system can be supplied directly:
+                #
+                # cds = proc.analyze(img_paths[i])
+
+            except Exception as e:
+                # Keep consuming the queue so that the reader thread does not block.
+                results[i] = e
+            finally:
+                mm.close()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads + 1)
 
-def main():
     try:
+        reader = executor.submit(read_files)
+        futures = [reader] + [executor.submit(analyze_files, proc) for proc in procs[:num_threads]]
 
-        # The simplelpr extension requires 64-bit Python 3.8 or 3.9
+        # Wait with a timeout, so that Ctrl+C is noticed promptly on every platform.
+        while concurrent.futures.wait(futures, timeout=0.5).not_done:
+            pass
+    except BaseException:
+        # Only the images already being analyzed are waited for.
+        stop.set()
+        raise
+    finally:
+        executor.shutdown(wait=True)
 
-        if sys.version_info[0:2] != (3, 8) and sys.version_info[0:2] != (3, 9):
-            raise RuntimeError('This demo requires either Python 3.8 or 3.9')
+    # Propagate any unexpected error raised by the reader thread. Errors of individual images are kept in the results.
+    reader.result()
 
-        if len(sys.argv) == 1:
-            sys.argv.append('--help')
+    return list(zip(img_paths, results))
+
+
+# Renders the detection results as a single string, either in text or JSON format.
+
+def render_results(results, as_json):
+    if as_json:
+        return json.dumps([{'image': p, 'error': str(cds)} if isinstance(cds, Exception) else candidates_to_dict(p, cds)
+                           for p, cds in results]) + '\n'
+
+    parts = []
+
+    for p, cds in results:
+        if isinstance(cds, Exception):
+            parts.append(IMAGE_ERROR_FORMAT.format(path=p, error=cds))
+        else:
+            parts.extend(format_candidates(p, cds))
+
+    return '\n'.join(parts) + '\n'
+
+
+def analyze_file(eng, country_id, img_path, key_path, num_threads, as_json):
+    img_paths = list_image_files(img_path)
+
+    if not img_paths:
+        raise RuntimeError(f'No image files found at {img_path}')
+
+    # The engine and the processors are set up only once, regardless of the number of images to be analyzed.
+    setup_engine(eng, country_id, key_path)
+    procs = create_processors(eng, max(1, min(num_threads, len(img_paths))))
+
+    results = analyze_images(procs, img_paths)
 
+    # Show the detection results. The whole report is written at once rather than line by line.
+    sys.stdout.write(render_results(results, as_json))
 
-        # Create a SimpleLPR engine.
 
-        setupP = simplelpr.EngineSetupParms()
-        eng = simplelpr.SimpleLPR(setupP)
+# Parses a 'host:port' server address. An empty host means 'localhost', rather than every network interface.
+
+def parse_address(address):
+    host, sep, port = address.rpartition(':')
+
+    if not sep or not port.isdigit():
+        raise RuntimeError("Address must be 'host:port'")
+
+    return host or 'localhost', int(port)
+
+
+# Builds an uncompressed 24-bit BMP image of the given size, filled in black.
+
+def blank_bmp(width, height):
+    pixels = bytes(((width * 3 + 3) & ~3) * height)
+    file_header = struct.pack('<2sIHHI', b'BM', 54 + len(pixels), 0, 0, 54)
+    info_header = struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24, 0, len(pixels), 2835, 2835, 0, 0)
+
+    return bytearray(file_header + info_header + pixels)
+
+
+# Runs a throwaway analysis on every processor, so that one-time initialization costs are paid upfront instead of
+# by the first real requests.
+
+def warm_up(procs):
+    img = blank_bmp(64, 64)
+
+    try:
+        for proc in procs:
+            proc.analyze(img)
+    except Exception as e:
+        print(f'Warm-up skipped: {e}')
+
 
-        print("SimpleLPR version:",
-              "{:}.{:}.{:}.{:}".format(eng.versionNumber.A, eng.versionNumber.B, eng.versionNumber.C,
-                                       eng.versionNumber.D))
+# Runs an analysis server, which keeps a ready to use engine and set of processors across requests. This way clients
+# don't pay the engine construction and setup costs on every invocation.
+
+def serve(eng, country_id, key_path, num_threads, address, authkey):
+    # Without a key, generate a random one that has to be handed to the clients.
+    if not authkey:
+        authkey = secrets.token_hex(16)
+        print(f'Authentication key: {authkey}')
+        print(f"Pass it to 'submit' with --authkey, or through the {AUTHKEY_ENV_VAR} environment variable.")
+
+    setup_engine(eng, country_id, key_path)
+    procs = create_processors(eng, max(1, num_threads))
+    warm_up(procs)
+
+    host, port = parse_address(address)
+
+    with multiprocessing.connection.Listener((host, port), authkey=authkey.encode()) as listener:
+        print(f'Listening on {host}:{port}. Press Ctrl+C to stop.')
+
+        while True:
+            try:
+                conn = listener.accept()
+            except KeyboardInterrupt:
+                break
+            except (multiprocessing.AuthenticationError, EOFError, OSError) as e:
+                print(f'Rejected connection: {e}')
+                continue
+
+            with conn:
+                try:
+                    request = conn.recv()
+
+                    # Each request carries a list of image paths and the desired output format. The reply is either
+                    # (True, rendered results) or (False, error message).
+                    try:
+                        img_paths, as_json = request
+                        reply = (True, render_results(analyze_images(procs, img_paths), as_json))
+                    except Exception as e:
+                        reply = (False, str(e))
+
+                    conn.send(reply)
+                except (EOFError, OSError) as e:
+                    # The client went away. Its failure must not stop the server from serving other clients.
+                    print(f'Lost connection with client: {e!r}')
+                except KeyboardInterrupt:
+                    break
+
+
+# Sends the images to be analyzed to an analysis server, and shows the results it replies with.
+
+def analyze_file_on_server(img_path, as_json, address, authkey):
+    if not authkey:
+        raise RuntimeError(f'An authentication key is required, either with --authkey or through the '
+                           f'{AUTHKEY_ENV_VAR} environment variable')
+
+    img_paths = list_image_files(img_path)
+
+    if not img_paths:
+        raise RuntimeError(f'No image files found at {img_path}')
+
+    # The server may be running on a different working directory.
+    img_paths = [os.path.abspath(p) for p in img_paths]
+
+    with multiprocessing.connection.Client(parse_address(address), authkey=authkey.encode()) as conn:
+        conn.send((img_paths, as_json))
+
+        try:
+            ok, reply = conn.recv()
+        except EOFError:
+            raise RuntimeError('The server closed the connection without replying')
+
+    if not ok:
+        raise RuntimeError(reply)
+
+    sys.stdout.write(reply)
+
+
+def main():
+    try:
+
+        if len(sys.argv) == 1:
+            sys.argv.append('--help')
 
         # Parse the command line arguments.
 
@@ -108,28 +437,90 @@ def main():
         subparsers.add_parser('list', help='List all available countries')
         parser_analyze = subparsers.add_parser('analyze', help='Looks for license plate candidates in an image')
         parser_analyze.add_argument('country_id', type=str, help='Country string identifier')
-        parser_analyze.add_argument('img_path', type=str, help='Path to the image file')
+        parser_analyze.add_argument('img_path',
+                                    type=str,
+                                    help='Path to an image file, a directory or a glob pattern. Quote glob patterns '
+                                         'to prevent shell expansion')
         parser_analyze.add_argument('key_path',
                                     type=str,
                                     nargs='?',
                                     help="Path to the registration key file. In case you need to extend the 60-day "
                                          "evaluation period you can send an e-mail to 'support@warelogic.com' to "
                                          "request a trial key")
+        parser_analyze.add_argument('-t', '--threads',
+                                    type=int,
+                                    default=os.cpu_count() or 1,
+                                    help='Number of worker threads, each one with its own processor. Defaults to the '
+                                         'number of CPUs')
+        parser_analyze.add_argument('--json',
+                                    action='store_true',
+                                    help='Print the results in JSON format')
+        parser_serve = subparsers.add_parser('serve',
+                                             help='Runs an analysis server that keeps the engine ready across requests')
+        parser_serve.add_argument('country_id', type=str, help='Country string identifier')
+        parser_serve.add_argument('key_path', type=str, nargs='?', help='Path to the registration key file')
+        parser_serve.add_argument('-t', '--threads',
+                                  type=int,
+                                  default=os.cpu_count() or 1,
+                                  help='Number of worker threads, each one with its own processor. Defaults to the '
+                                       'number of CPUs')
+        parser_serve.add_argument('--address',
+                                  type=str,
+                                  default=DEFAULT_SERVER_ADDRESS,
+                                  help=f"Address to listen on, as 'host:port'. Defaults to '{DEFAULT_SERVER_ADDRESS}'")
+        parser_serve.add_argument('--authkey',
+                                  type=str,
+                                  default=os.environ.get(AUTHKEY_ENV_VAR),
+                                  help=f'Authentication key clients must supply. Defaults to the {AUTHKEY_ENV_VAR} '
+                                       'environment variable. If neither is given, a random key is generated and '
+                                       'printed')
+        parser_submit = subparsers.add_parser('submit',
+                                              help="Sends images to an analysis server started with the 'serve' "
+                                                   "command. The server's country and registration key are used")
+        parser_submit.add_argument('img_path',
+                                   type=str,
+                                   help='Path to an image file, a directory or a glob pattern. Quote glob patterns '
+                                        'to prevent shell expansion')
+        parser_submit.add_argument('--json',
+                                   action='store_true',
+                                   help='Print the results in JSON format')
+        parser_submit.add_argument('--address',
+                                   type=str,
+                                   default=DEFAULT_SERVER_ADDRESS,
+                                   help=f"Address of the server, as 'host:port'. Defaults to "
+                                        f"'{DEFAULT_SERVER_ADDRESS}'")
+        parser_submit.add_argument('--authkey',
+                                   type=str,
+                                   default=os.environ.get(AUTHKEY_ENV_VAR),
+                                   help='Authentication key shared with the analysis server. Defaults to the '
+                                        f'{AUTHKEY_ENV_VAR} environment variable')
 
         args = parser.parse_args()
 
+        # The SimpleLPR engine is only created once the command line is known to be valid. Its version is not shown
+        # along JSON output, to keep the output machine readable.
+
         if args.command == 'list':
             # List countries.
-            list_countries(eng)
+            list_countries(create_engine(True))
         elif args.command == 'analyze':
-            # Analyze an image in the file system.
-            analyze_file(eng, args.country_id, args.img_path, args.key_path)
+            # Analyze one or more images in the file system.
+            analyze_file(create_engine(not args.json), args.country_id, args.img_path, args.key_path, args.threads,
+                         args.json)
+        elif args.command == 'serve':
+            # Analyze images on behalf of clients.
+            serve(create_engine(True), args.country_id, args.key_path, args.threads, args.address, args.authkey)
+        elif args.command == 'submit':
+            # Analyze one or more images in the file system using an analysis server.
+            analyze_file_on_server(args.img_path, args.json, args.address, args.authkey)
         else:
             # Shouldn't occur.
             raise RuntimeError('Unknown command')
 
+    except KeyboardInterrupt:
+        print('Interrupted')
     except Exception as e:
-        print('An exception occurred: {}'.format(e))
+        print(f'An exception occurred: {e}')
 
 
 if __name__ == '__main__':